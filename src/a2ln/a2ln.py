@@ -15,11 +15,16 @@
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import argparse
+import asyncio
+import collections
 import io
 import os
+import queue
+import re
 import signal
 import socket
 import subprocess
+import sys
 import tempfile
 import threading
 import time
@@ -27,24 +32,38 @@ import traceback
 from argparse import Namespace
 from importlib import metadata
 from pathlib import Path
-from typing import Optional
+from typing import Any, AnyStr, Deque, List, Optional, Set, Tuple, Union
 
-import gi
-import qrcode  # type: ignore
 import zmq
+import zmq.asyncio
 import zmq.auth
-import zmq.auth.thread
+import zmq.auth.asyncio
 import zmq.error
-from PIL import Image
-
-gi.require_version('Notify', '0.7')
-
-from gi.repository import Notify  # type: ignore # noqa: E402
 
 BOLD = "\033[1m"
 RESET = "\033[0m"
 
 DEFAULT_PORT = 23045
+DEFAULT_PAIRING_TIMEOUT = 60
+
+DEBUG = bool(os.environ.get("A2LN_DEBUG"))
+
+RECEIVE_HIGH_WATER_MARK = 10000
+RECEIVE_BUFFER_SIZE = 4 * 1024 * 1024
+TCP_KEEPALIVE_IDLE = 60
+
+PLACEHOLDERS = ("app", "title", "body")
+PLACEHOLDER_PATTERN = re.compile(r"{(app|title|body)}")
+
+PICTURE_FILE_LIFETIME = 60
+MAXIMUM_PICTURE_FILES = 100
+
+PICTURE_DIRECTORY = "/dev/shm" if os.access("/dev/shm", os.W_OK) else None
+
+PICTURE_SUFFIXES = {
+    b"\x89PNG": ".png",
+    b"\xff\xd8\xff": ".jpg"
+}
 
 
 def main() -> None:
@@ -84,12 +103,29 @@ def main() -> None:
 
         exit(1)
 
+    cpus = os.environ.get("A2LN_CPUS")
+
+    if cpus:
+        try:
+            os.sched_setaffinity(0, parse_cpus(cpus))
+        except (ValueError, OSError):
+            print(f"CPUs {cpus} are invalid.")
+
+            exit(1)
+
+    context = zmq.asyncio.Context.instance()
+
     if args.command == "pair":
-        server = PairingServer(clients_directory, own_public_key, args.ip, args.port)
+        server = PairingServer(context, clients_directory, own_public_key, args.ip, args.port, args.timeout)
     elif own_secret_key:
-        server = NotificationServer(clients_directory, own_public_key, own_secret_key, args.ip, args.port,
+        server = NotificationServer(context, clients_directory, own_public_key, own_secret_key, args.ip, args.port,
                                     args.title_format, args.body_format, args.command)
 
+        Notify = load_notify()
+
+        Notify.init("Android 2 Linux Notifications")
+        Notify.get_server_caps()
+
         signal.signal(signal.SIGUSR1, lambda number, frame: server.toggle())
     else:
         print(f"Own keys file at {own_keys_file} is missing the private key.")
@@ -97,10 +133,16 @@ def main() -> None:
         exit(1)
 
     try:
-        server.start()
+        import uvloop  # type: ignore
+    except ImportError:
+        pass
+    else:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    try:
+        asyncio.run(server.serve())
 
-        while server.is_alive():
-            time.sleep(1)
+        context.term()
 
         exit(1)
     except KeyboardInterrupt:
@@ -129,10 +171,74 @@ def parse_args() -> Namespace:
 
     pair_parser.add_argument("--ip", type=str, default="*", help="The IP to listen")
     pair_parser.add_argument("--port", type=int, help="The port to listen, random by default")
+    pair_parser.add_argument("--timeout", type=int, default=DEFAULT_PAIRING_TIMEOUT, help="The seconds to wait for a "
+                                                                                          "pairing request to be "
+                                                                                          "accepted")
 
     return argument_parser.parse_args()
 
 
+async def read_input(prompt: str, timeout: float) -> Optional[str]:
+    loop = asyncio.get_running_loop()
+
+    future = loop.create_future()
+
+    print(prompt, end="", flush=True)
+
+    try:
+        loop.add_reader(sys.stdin, lambda: future.done() or future.set_result(sys.stdin.readline()))
+    except OSError:
+        # Regular files cannot be polled, so read them in a thread instead.
+        try:
+            return await asyncio.wait_for(loop.run_in_executor(None, input), timeout)
+        except EOFError:
+            return ""
+        except asyncio.TimeoutError:
+            print()
+
+            return None
+
+    try:
+        return (await asyncio.wait_for(future, timeout)).rstrip("\n")
+    except asyncio.TimeoutError:
+        print()
+
+        return None
+    finally:
+        loop.remove_reader(sys.stdin)
+
+
+def quote(text: bytes) -> bytes:
+    return b"'" + text.replace(b"'", b"'\\''") + b"'"
+
+
+def write_file_atomically(path: str, data: bytes) -> None:
+    temporary_path = f"{path}.tmp"
+
+    descriptor = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+
+    try:
+        os.write(descriptor, data)
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+    os.replace(temporary_path, path)
+
+
+def render_qr_code(data: str) -> str:
+    import qrcode  # type: ignore
+
+    qr_code = qrcode.QRCode()
+
+    qr_code.add_data(data)
+
+    with io.StringIO() as qr_code_buffer:
+        qr_code.print_ascii(out=qr_code_buffer)
+
+        return qr_code_buffer.getvalue()
+
+
 def get_ip() -> str:
     with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client:
         client.connect(("8.8.8.8", 80))
@@ -140,13 +246,102 @@ def get_ip() -> str:
         return client.getsockname()[0]
 
 
-def send_notification(title: str, body: str, picture_file=None) -> None:
+def parse_cpus(text: str) -> Set[int]:
+    cpus = set()
+
+    for part in text.split(","):
+        start, _, end = part.partition("-")
+
+        cpus.update(range(int(start), int(end or start) + 1))
+
+    return cpus
+
+
+def compile_format(text: str) -> List[Tuple[str, Optional[int]]]:
+    parts = PLACEHOLDER_PATTERN.split(text)
+
+    return list(zip(parts[::2], [PLACEHOLDERS.index(placeholder) for placeholder in parts[1::2]] + [None]))
+
+
+def encode_format(tokens: List[Tuple[str, Optional[int]]]) -> List[Tuple[bytes, Optional[int]]]:
+    return [(literal.encode("utf-8"), placeholder) for literal, placeholder in tokens]
+
+
+def apply_format(tokens: List[Tuple[AnyStr, Optional[int]]], values: Tuple[AnyStr, ...]) -> AnyStr:
+    return tokens[0][0][:0].join(literal if placeholder is None else literal + values[placeholder]
+                                 for literal, placeholder in tokens)
+
+
+def get_picture_suffix(picture: Union[bytes, memoryview]) -> Optional[str]:
+    header = bytes(picture[:8])
+
+    for magic, suffix in PICTURE_SUFFIXES.items():
+        if header.startswith(magic):
+            return suffix
+
+    return None
+
+
+def create_picture_file(picture: Union[bytes, memoryview]) -> str:
+    suffix = get_picture_suffix(picture)
+
+    if suffix is None:
+        from PIL import Image
+
+        with io.BytesIO() as picture_buffer:
+            Image.open(io.BytesIO(picture)).save(picture_buffer, "PNG")
+
+            picture = picture_buffer.getvalue()
+
+        suffix = ".png"
+
+    descriptor, picture_file = tempfile.mkstemp(suffix=suffix, prefix="a2ln-", dir=PICTURE_DIRECTORY)
+
+    try:
+        os.write(descriptor, picture)
+    except OSError:
+        delete_picture_file(picture_file)
+
+        raise
+    finally:
+        os.close(descriptor)
+
+    return picture_file
+
+
+def delete_picture_file(picture_file: str) -> None:
+    try:
+        os.unlink(picture_file)
+    except FileNotFoundError:
+        pass
+
+
+def load_notify() -> Any:
+    import gi
+
+    gi.require_version('Notify', '0.7')
+
+    from gi.repository import Notify  # type: ignore
+
+    return Notify
+
+
+def send_notification(notification, title: str, body: str, picture_file: Optional[str] = None) -> None:
     if picture_file is None:
-        Notify.Notification.new(title, body, "dialog-information").show()
+        notification.update(title, body, "dialog-information")
     else:
-        Notify.Notification.new(title, body, picture_file.name).show()
+        notification.update(title, body, picture_file)
+
+    # Reset the ID so that libnotify shows a new notification instead of replacing the previous one.
+    notification.props.id = 0
 
-        picture_file.close()
+    notification.show()
+
+
+def configure_socket(server: zmq.Socket) -> None:
+    server.setsockopt(zmq.RCVHWM, RECEIVE_HIGH_WATER_MARK)
+    server.setsockopt(zmq.TCP_KEEPALIVE, 1)
+    server.setsockopt(zmq.TCP_KEEPALIVE_IDLE, TCP_KEEPALIVE_IDLE)
 
 
 def handle_error(error: zmq.error.ZMQError) -> None:
@@ -156,16 +351,19 @@ def handle_error(error: zmq.error.ZMQError) -> None:
         print("Permission is missing (note that you must use a port higher than 1023 if you are not root).")
     elif error.errno == 19:
         print("IP is invalid.")
-    else:
+    elif DEBUG:
         traceback.print_exc()
+    else:
+        print(f"ZMQ error {error.errno} ({error.strerror}).")
 
 
-class NotificationServer(threading.Thread):
-    def __init__(self, clients_directory: Path, own_public_key: bytes, own_secret_key: bytes, ip: str,
-                 port: int, title_format: str, body_format: str, command: Optional[str]):
-        super(NotificationServer, self).__init__(daemon=True)
-
+class NotificationServer:
+    def __init__(self, context: zmq.asyncio.Context, clients_directory: Path, own_public_key: bytes,
+                 own_secret_key: bytes, ip: str, port: int, title_format: str, body_format: str,
+                 command: Optional[str]):
+        self.context = context
         self.clients_directory = clients_directory
+        self.clients_location = clients_directory.as_posix()
         self.own_public_key = own_public_key
         self.own_secret_key = own_secret_key
         self.ip = ip
@@ -174,71 +372,150 @@ class NotificationServer(threading.Thread):
         self.body_format = body_format
         self.command = command
 
+        self.title_tokens = compile_format(title_format)
+        self.body_tokens = compile_format(body_format)
+        self.command_tokens = None if command is None else encode_format(compile_format(command))
+
+        app_placeholder = PLACEHOLDERS.index("app")
+
+        self.app_needed = any(placeholder == app_placeholder
+                              for tokens in (self.title_tokens, self.body_tokens)
+                              for _, placeholder in tokens)
+
         self.enabled = True
 
-    def run(self) -> None:
-        super(NotificationServer, self).run()
+        self.shell: Optional[subprocess.Popen] = None
+
+        self.notification_queue: queue.SimpleQueue = queue.SimpleQueue()
 
-        with zmq.Context() as context:
-            authenticator = zmq.auth.thread.ThreadAuthenticator(context)
+    async def serve(self) -> None:
+        authenticator = zmq.auth.asyncio.AsyncioAuthenticator(self.context)
 
-            authenticator.start()
+        authenticator.start()
 
-            authenticator.configure_curve(domain="*", location=self.clients_directory.as_posix())
+        try:
+            authenticator.configure_curve(domain="*", location=self.clients_location)
 
-            with context.socket(zmq.PULL) as server:
+            with self.context.socket(zmq.PULL) as server:
                 server.curve_publickey = self.own_public_key
                 server.curve_secretkey = self.own_secret_key
 
                 server.curve_server = True
 
+                configure_socket(server)
+
+                server.setsockopt(zmq.RCVBUF, RECEIVE_BUFFER_SIZE)
+
                 try:
                     server.bind(f"tcp://{self.ip}:{self.port}")
                 except zmq.error.ZMQError as error:
-                    authenticator.stop()
-
                     handle_error(error)
 
                     return
 
                 print(f"Notification server running on IP {BOLD}{self.ip}{RESET} and port {BOLD}{self.port}{RESET}.")
 
-                Notify.init("Android 2 Linux Notifications")
+                threading.Thread(target=self.send_notifications, daemon=True).start()
 
                 while True:
-                    request = server.recv_multipart()
+                    requests = [await server.recv_multipart(copy=False)]
 
-                    length = len(request)
+                    while len(requests) < RECEIVE_HIGH_WATER_MARK:
+                        try:
+                            requests.append(await server.recv_multipart(zmq.NOBLOCK, copy=False))
+                        except zmq.Again:
+                            break
 
-                    if length != 3 and length != 4:
-                        continue
+                    if self.enabled:
+                        for request in requests:
+                            if len(request) not in (3, 4):
+                                continue
 
-                    if length == 4:
-                        picture_file = tempfile.NamedTemporaryFile(suffix=".png")
+                            self.notification_queue.put(request)
 
-                        Image.open(io.BytesIO(request[3])).save(picture_file.name)
-                    else:
-                        picture_file = None
+                    # Receiving ready messages never suspends, so give the authenticator a turn between batches.
+                    await asyncio.sleep(0)
+        finally:
+            authenticator.stop()
 
-                    app = request[0].decode("utf-8")
-                    title = request[1].decode("utf-8")
-                    body = request[2].decode("utf-8")
+    def handle_request(self, notification, request: List[zmq.Frame]) -> Optional[str]:
+        app = request[0].bytes.decode("utf-8") if self.app_needed else ""
+        title = request[1].bytes.decode("utf-8")
+        body = request[2].bytes.decode("utf-8")
 
-                    print()
-                    print(f"Received notification (Title: {BOLD}{title}{RESET}, Body: {BOLD}{body}{RESET})")
+        print()
+        print(f"Received notification (Title: {BOLD}{title}{RESET}, Body: {BOLD}{body}{RESET})")
+
+        if not self.enabled:
+            return
+
+        if len(request) == 4:
+            picture_file = create_picture_file(request[3].buffer)
+        else:
+            picture_file = None
+
+        values = (app, title, body)
+
+        try:
+            send_notification(notification, apply_format(self.title_tokens, values),
+                              apply_format(self.body_tokens, values), picture_file)
+
+            if self.command_tokens is not None:
+                self.run_command(apply_format(self.command_tokens,
+                                              (request[0].bytes, request[1].bytes, request[2].bytes)))
+        except Exception:
+            if picture_file is not None:
+                delete_picture_file(picture_file)
+
+            raise
+
+        return picture_file
+
+    def run_command(self, command: bytes) -> None:
+        line = b"(eval " + quote(command) + b" &)\n"
+
+        if self.shell is not None:
+            try:
+                self.shell.stdin.write(line)
+
+                return
+            except BrokenPipeError:
+                self.shell.wait()
 
-                    if not self.enabled:
-                        continue
+        self.shell = subprocess.Popen(["/bin/sh"], stdin=subprocess.PIPE, bufsize=0)
 
-                    def replace(text: str) -> str:
-                        return text.replace("{app}", app).replace("{title}", title).replace("{body}", body)
+        self.shell.stdin.write(line)
 
-                    threading.Thread(target=send_notification,
-                                     args=(replace(self.title_format), replace(self.body_format), picture_file),
-                                     daemon=True).start()
+    def send_notifications(self) -> None:
+        notification = load_notify().Notification.new("", "", "dialog-information")
 
-                    if self.command is not None:
-                        subprocess.Popen(replace(self.command), shell=True)
+        picture_files: Deque[Tuple[float, str]] = collections.deque()
+
+        while True:
+            while picture_files and (picture_files[0][0] <= time.monotonic()
+                                     or len(picture_files) > MAXIMUM_PICTURE_FILES):
+                delete_picture_file(picture_files.popleft()[1])
+
+            try:
+                if picture_files:
+                    request = self.notification_queue.get(timeout=max(picture_files[0][0] - time.monotonic(), 0))
+                else:
+                    request = self.notification_queue.get()
+            except queue.Empty:
+                continue
+
+            try:
+                picture_file = self.handle_request(notification, request)
+
+                # The notification daemon may only load the picture after show() returned, so keep it around for a
+                # while.
+                if picture_file is not None:
+                    picture_files.append((time.monotonic() + PICTURE_FILE_LIFETIME, picture_file))
+            except Exception as error:
+                if DEBUG:
+                    traceback.print_exc()
+                else:
+                    print(f"Failed to handle notification: {error!r}")
 
     def toggle(self) -> None:
         self.enabled = not self.enabled
@@ -251,19 +528,26 @@ class NotificationServer(threading.Thread):
             print(f"Notifications disabled.")
 
 
-class PairingServer(threading.Thread):
-    def __init__(self, clients_directory: Path, own_public_key: bytes, ip: str, port: Optional[int]):
-        super(PairingServer, self).__init__(daemon=True)
-
+class PairingServer:
+    def __init__(self, context: zmq.asyncio.Context, clients_directory: Path, own_public_key: bytes, ip: str,
+                 port: Optional[int], timeout: int):
+        self.context = context
         self.clients_directory = clients_directory
+        self.clients_location = clients_directory.as_posix()
         self.own_public_key = own_public_key
         self.ip = ip
         self.port = port
+        self.timeout = timeout
+
+        self.own_public_key_text = own_public_key.decode("utf-8")
+        self.own_public_key_frame = zmq.Frame(own_public_key)
 
-    def run(self) -> None:
-        super(PairingServer, self).run()
+        self.pairing: Optional[asyncio.Future] = None
+
+    async def serve(self) -> None:
+        with self.context.socket(zmq.ROUTER) as server:
+            configure_socket(server)
 
-        with zmq.Context() as context, context.socket(zmq.REP) as server:
             try:
                 if self.port is None:
                     self.port = server.bind_to_random_port(f"tcp://{self.ip}")
@@ -276,10 +560,8 @@ class PairingServer(threading.Thread):
 
             ip = get_ip()
 
-            qr_code = qrcode.QRCode()
-
-            qr_code.add_data(f"{ip}:{self.port}")
-            qr_code.print_ascii()
+            sys.stdout.write(await asyncio.get_running_loop().run_in_executor(None, render_qr_code,
+                                                                              f"{ip}:{self.port}"))
 
             print(f"Pairing server running on IP {BOLD}{self.ip}{RESET} and port {BOLD}{self.port}{RESET}. To pair a "
                   f"new device, open the Android 2 Linux Notifications app and scan this QR code or enter the "
@@ -287,39 +569,85 @@ class PairingServer(threading.Thread):
             print(f"IP: {BOLD}{ip}{RESET}")
             print(f"Port: {BOLD}{self.port}{RESET}")
             print()
-            print(f"Public Key: {BOLD}{self.own_public_key.decode('utf-8')}{RESET}")
+            print(f"Public Key: {BOLD}{self.own_public_key_text}{RESET}")
             print()
             print("After pairing, ensure to restart any running notification servers.")
 
             while True:
-                request = server.recv_multipart()
+                request = await server.recv_multipart()
+
+                try:
+                    delimiter = request.index(b"")
+                except ValueError:
+                    print()
+                    print("Malformed pairing request rejected.")
 
-                if len(request) != 2:
                     continue
 
-                client_ip = request[0].decode("utf-8")
-                client_public_key = request[1].decode("utf-8")
+                envelope = request[:delimiter + 1]
+                request = request[delimiter + 1:]
 
-                print()
-                print("New pairing request:")
-                print()
-                print(f"IP: {BOLD}{client_ip}{RESET}")
-                print(f"Public Key: {BOLD}{client_public_key}{RESET}")
-                print()
+                if len(request) != 2:
+                    print()
+                    print("Malformed pairing request rejected.")
 
-                if input("Accept? (Yes/No): ").lower() != "yes":
-                    print("Pairing cancelled.")
+                    await server.send_multipart(envelope + [b""])
 
-                    server.send(b"")
+                    continue
+
+                if self.pairing is not None and not self.pairing.done():
+                    print()
+                    print(f"Pairing request from {BOLD}{request[0].decode('utf-8', 'replace')}{RESET} rejected "
+                          f"(another request is pending).")
+
+                    await server.send_multipart(envelope + [b""])
 
                     continue
 
-                with open((self.clients_directory / client_ip).as_posix() + ".key", "w",
-                          encoding="utf-8") as client_file:
-                    client_file.write("metadata\n"
-                                      "curve\n"
-                                      f"    public-key = \"{client_public_key}\"\n")
+                self.pairing = asyncio.ensure_future(self.pair(server, envelope, request[0].decode("utf-8"),
+                                                               request[1].decode("utf-8")))
+
+    async def pair(self, server: zmq.asyncio.Socket, envelope: List[bytes], client_ip: str,
+                   client_public_key: str) -> None:
+        try:
+            reply = await self.confirm(client_ip, client_public_key)
+        except Exception as error:
+            if DEBUG:
+                traceback.print_exc()
+            else:
+                print(f"Failed to handle pairing request: {error!r}")
+
+            reply = b""
+
+        await server.send_multipart(envelope + [reply], copy=False)
+
+        if reply is self.own_public_key_frame:
+            print("Pairing finished.")
+
+    async def confirm(self, client_ip: str, client_public_key: str) -> Union[bytes, zmq.Frame]:
+        print()
+        print("New pairing request:")
+        print()
+        print(f"IP: {BOLD}{client_ip}{RESET}")
+        print(f"Public Key: {BOLD}{client_public_key}{RESET}")
+        print()
+
+        answer = await read_input("Accept? (Yes/No): ", self.timeout)
+
+        if answer is None:
+            print("Pairing timed out.")
+
+            return b""
+
+        if answer.lower() != "yes":
+            print("Pairing cancelled.")
+
+            return b""
+
+        client_key = ("metadata\n"
+                      "curve\n"
+                      f"    public-key = \"{client_public_key}\"\n")
 
-                server.send(self.own_public_key)
+        write_file_atomically(f"{self.clients_location}/{client_ip}.key", client_key.encode("utf-8"))
 
-                print("Pairing finished.")
+        return self.own_public_key_frame